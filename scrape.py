@@ -1,16 +1,47 @@
 import re
-import pandas as pd
-from bs4 import BeautifulSoup, Comment
+import requests
+import lxml.html
 from geopy.geocoders import Nominatim
+from geopy.adapters import RequestsAdapter
+from geopy.extra.rate_limiter import RateLimiter
+from tqdm import tqdm
 import time
-import datetime
 import os
+import sys
 import csv
+import bisect
+import sqlite3
+import threading
+from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Pre-compiled regexes used in the per-row parsing loop
+_WS = re.compile(r'\s+')
+_NON_ALNUM = re.compile(r'[^a-z0-9 ]')
+_POSTCODE_RE = re.compile(r'^\d{4}$')
+_TR_RE = re.compile(r'<tr[\s>]')
+_PROVIDER_COMMENT_RE = re.compile(r'<!--\s*<td>(\d+)</td>\s*-->')
+
 # Helper to normalize whitespace
 def clean_text(text):
-    return re.sub(r'\s+', ' ', text).strip()
+    return _WS.sub(' ', text).strip()
+
+# Map provider-number comments to row indexes with one regex scan over the
+# raw HTML: each comment belongs to the <tr> opened most recently before it,
+# and (as before) the last numbered comment in a row wins.
+def build_provider_numbers(html):
+    tr_offsets = [m.start() for m in _TR_RE.finditer(html)]
+    provider_by_row = {}
+    for m in _PROVIDER_COMMENT_RE.finditer(html):
+        row_idx = bisect.bisect_right(tr_offsets, m.start()) - 1
+        if row_idx >= 0:
+            provider_by_row[row_idx] = m.group(1)
+    return provider_by_row
+
+# Normalize an address for cache keying: lowercase, strip punctuation and
+# collapse whitespace, so trivially different spellings share one cache entry
+def normalize_address(addr):
+    return _WS.sub(' ', _NON_ALNUM.sub(' ', addr.lower())).strip()
 
 # Helper to extract company name (before ' - ')
 def extract_company(name):
@@ -18,58 +49,166 @@ def extract_company(name):
         return name.split(' - ')[0].strip()
     return name.strip()
 
-CACHE_FILE = 'geocode_cache.csv'
+SEARCH_URL = 'https://www.sira.nsw.gov.au/information-search/rehab-provider/search'
+HTML_FILE = 'data-raw.html'
+CACHE_FILE = 'geocode_cache.csv'  # legacy cache, imported into SQLite on first run
+CACHE_DB = 'geocode_cache.sqlite'
+
+# Fetch the search results page with a single HTTP request (no browser needed)
+def fetch_html():
+    session = requests.Session()
+    response = session.get(
+        SEARCH_URL,
+        headers={'User-Agent': 'Mozilla/5.0 (compatible; sira-rtw-scraper)'},
+        timeout=30,
+    )
+    response.raise_for_status()
+    # Only persist the snapshot if it actually contains the provider table;
+    # a JS-rendered shell saved here would poison every later run.
+    if not lxml.html.fromstring(response.text).xpath('//tr/td[7]'):
+        sys.exit(
+            f"Error: page fetched from {SEARCH_URL} contains no provider table "
+            f"(JS-rendered?). Snapshot not saved; save the rendered page "
+            f"manually as {HTML_FILE} and re-run."
+        )
+    with open(HTML_FILE, 'w', encoding='utf-8') as f:
+        f.write(response.text)
+    return response.text
 
-def load_geocode_cache():
-    cache = {}
-    if os.path.exists(CACHE_FILE):
+# Persistent geocode cache backed by SQLite. Lookups are keyed B-tree probes
+# and each new result is written incrementally, instead of reading and
+# rewriting the whole CSV on every run.
+class GeocodeCache:
+    def __init__(self, path=CACHE_DB):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS geo(addr TEXT PRIMARY KEY, lat REAL, lon REAL, ts REAL, orig TEXT)"
+        )
+        try:
+            # Upgrade databases created before the orig column existed
+            self._conn.execute("ALTER TABLE geo ADD COLUMN orig TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self._import_legacy_csv()
+
+    def _import_legacy_csv(self):
+        if not os.path.exists(CACHE_FILE):
+            return
         with open(CACHE_FILE, 'r', encoding='utf-8') as f:
             reader = csv.reader(f)
             for row in reader:
-                if len(row) == 3:
-                    addr, lat, lon = row
-                    if lat and lon:
-                        cache[addr] = (float(lat), float(lon))
-    return cache
+                if len(row) == 3 and row[1] and row[2]:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO geo(addr, lat, lon, ts, orig) VALUES (?, ?, ?, ?, ?)",
+                        (normalize_address(row[0]), float(row[1]), float(row[2]), time.time(), row[0]),
+                    )
+        self._conn.commit()
+
+    def get(self, addr):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT lat, lon FROM geo WHERE addr=?", (normalize_address(addr),)
+            ).fetchone()
 
-def save_geocode_cache(cache):
-    with open(CACHE_FILE, 'w', encoding='utf-8', newline='') as f:
-        writer = csv.writer(f)
-        for addr, (lat, lon) in cache.items():
-            writer.writerow([addr, lat, lon])
+    def __contains__(self, addr):
+        return self.get(addr) is not None
 
-# Read the HTML file
-with open('data-raw.html', 'r', encoding='utf-8') as f:
-    html = f.read()
+    def __getitem__(self, addr):
+        coords = self.get(addr)
+        if coords is None:
+            raise KeyError(addr)
+        return coords
 
-soup = BeautifulSoup(html, 'html.parser')
-rows = soup.find_all('tr')
+    def __setitem__(self, addr, coords):
+        lat, lon = coords
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geo(addr, lat, lon, ts, orig) VALUES (?, ?, ?, ?, ?)",
+                (normalize_address(addr), lat, lon, time.time(), addr),
+            )
+            self._pending += 1
+            if self._pending >= 50:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+# Read the HTML file (fetch it first if there is no local snapshot)
+if os.path.exists(HTML_FILE):
+    with open(HTML_FILE, 'r', encoding='utf-8') as f:
+        html = f.read()
+else:
+    html = fetch_html()
+
+tree = lxml.html.fromstring(html)
+rows = tree.xpath('//tr')
+provider_numbers = build_provider_numbers(html)
 
 data = []
-geolocator = Nominatim(user_agent="sira_rtw_scraper_v2")
+
+# Geocoding backends. Default is the public Nominatim service, which must be
+# rate limited to ~1 request/sec. Set NOMINATIM_URL to a self-hosted instance
+# (e.g. docker run mediagis/nominatim) to drop the rate limit entirely, or
+# MAPBOX_TOKEN to bulk-resolve addresses through the Mapbox batch geocoding
+# API first (Mapbox covers Australia; Geocodio was ruled out because it only
+# geocodes US and Canadian addresses).
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL')
+MAPBOX_TOKEN = os.environ.get('MAPBOX_TOKEN')
+
+if NOMINATIM_URL:
+    _parsed = urlparse(NOMINATIM_URL)
+    geolocator = Nominatim(
+        user_agent="sira_rtw_scraper_v2",
+        domain=_parsed.netloc,
+        scheme=_parsed.scheme or 'http',
+        adapter_factory=RequestsAdapter,
+    )
+    GEOCODE_DELAY = 0  # self-hosted: no usage policy to respect
+else:
+    geolocator = Nominatim(user_agent="sira_rtw_scraper_v2", adapter_factory=RequestsAdapter)
+    GEOCODE_DELAY = 1.1
+
+# Batch-geocode a list of addresses via Mapbox (up to 1000 per request).
+# Returns {address: (lat, lon) or None}.
+def geocode_batch_mapbox(addresses):
+    resolved = {}
+    for start in range(0, len(addresses), 1000):
+        chunk = addresses[start:start + 1000]
+        response = requests.post(
+            'https://api.mapbox.com/search/geocode/v6/batch',
+            params={'access_token': MAPBOX_TOKEN},
+            json=[{'q': addr, 'limit': 1, 'country': 'au'} for addr in chunk],
+            timeout=120,
+        )
+        response.raise_for_status()
+        for addr, result in zip(chunk, response.json()['batch']):
+            features = result.get('features', [])
+            if features:
+                lon, lat = features[0]['geometry']['coordinates']
+                resolved[addr] = (lat, lon)
+            else:
+                resolved[addr] = None
+    return resolved
 
 # Parse all rows and build a list of dicts (without geocoding yet)
 for idx, row in enumerate(rows):
-    tds = row.find_all('td')
-    # Find all comments in the row (BeautifulSoup treats comments as Comment type)
-    provider_number = None
-    for c in row.children:
-        if isinstance(c, Comment):
-            match = re.search(r'<td>(\d+)</td>', c)
-            if match:
-                provider_number = match.group(1)  # Always use the last one found
-    # If multiple, take the last one (usually the second one)
-    # (If you want the first, use break after assigning)
+    tds = row.xpath('./td')
+    provider_number = provider_numbers.get(idx)
     if len(tds) >= 7:
-        link_tag = tds[0].find('a')
-        name = clean_text(link_tag.text) if link_tag else ''
-        link = link_tag['href'] if link_tag else ''
-        business_address = clean_text(tds[1].text)
-        suburb = clean_text(tds[2].text)
-        state = clean_text(tds[3].text)
-        postcode = clean_text(tds[4].text)
-        region = clean_text(tds[5].text)
-        phone = clean_text(tds[6].text)
+        links = tds[0].xpath('.//a')
+        name = clean_text(links[0].text_content()) if links else ''
+        link = links[0].get('href', '') if links else ''
+        business_address = clean_text(tds[1].text_content())
+        suburb = clean_text(tds[2].text_content())
+        state = clean_text(tds[3].text_content())
+        postcode = clean_text(tds[4].text_content())
+        region = clean_text(tds[5].text_content())
+        phone = clean_text(tds[6].text_content())
         company = extract_company(name)
         full_address = f"{business_address}, {suburb}, {state} {postcode}, Australia"
         data.append({
@@ -86,91 +225,113 @@ for idx, row in enumerate(rows):
             'Full address': full_address
         })
 
-# Load geocode cache
-geocode_cache = load_geocode_cache()
+if not data:
+    sys.exit(
+        f"Error: no provider rows parsed from {HTML_FILE}. Delete the file "
+        f"to re-fetch it, or replace it with a rendered copy of {SEARCH_URL}."
+    )
+
+# Open geocode cache (imports the legacy CSV cache if present)
+geocode_cache = GeocodeCache()
+
+# Helper: fallback address attempts for a row, most to least specific.
+# Attempts that cannot possibly geocode (blank street address, malformed
+# postcode) are skipped so they never cost an API call.
+def build_attempts(row):
+    attempts = []
+    if row['Business address'].strip():
+        attempts.append(row['Full address'])
+    if _POSTCODE_RE.match(row['Postcode']):
+        attempts.append(f"{row['Postcode']}, Australia")
+        attempts.append(f"{row['Suburb']}, {row['State']} {row['Postcode']}, Australia")
+    return attempts
+
+# First pass: collect the attempts for every row and deduplicate. Many rows
+# share the same postcode/suburb fallback, so each unique address string is
+# geocoded at most once instead of once per row. Rows that already resolve
+# from cache contribute nothing.
+attempts_per_row = [build_attempts(row) for row in data]
+skipped_attempts = 3 * len(data) - sum(len(a) for a in attempts_per_row)
+if skipped_attempts:
+    print(f"Skipped {skipped_attempts} un-geocodable address attempts")
+to_fetch = []
+_queued = set()
+cached_rows = 0
+for attempts in attempts_per_row:
+    if any(a in geocode_cache for a in attempts):
+        cached_rows += 1
+        continue
+    for a in attempts:
+        if a not in _queued:
+            _queued.add(a)
+            to_fetch.append(a)
+
+rate_limited_geocode = RateLimiter(geolocator.geocode, min_delay_seconds=GEOCODE_DELAY)
+
+# Optional Mapbox batch pass: resolves most addresses in a couple of HTTP
+# calls and seeds the cache, so the Nominatim loop below only mops up misses.
+if MAPBOX_TOKEN and to_fetch:
+    batch_resolved = geocode_batch_mapbox(to_fetch)
+    for addr, coords in batch_resolved.items():
+        if coords:
+            geocode_cache[addr] = coords
+    to_fetch = [a for a in to_fetch if a not in geocode_cache]
+
+# Report the work upfront: the fetch list is final at this point, so the
+# rate-limit budget (and the ETA below) covers only truly new addresses.
+print(f"{cached_rows}/{len(data)} rows already cached; "
+      f"need {len(to_fetch)} API calls, est {int(len(to_fetch) * GEOCODE_DELAY)} s")
+
+# Threaded API requests for the remaining unique addresses. The RateLimiter
+# is thread-safe and spaces out the requests itself, so the workers overlap
+# network latency, response parsing and cache writes while outbound traffic
+# stays at ~1 request/sec for Nominatim.
+def geocode_address(attempt):
+    try:
+        location = rate_limited_geocode(attempt)
+        if location:
+            geocode_cache[attempt] = (location.latitude, location.longitude)
+    except Exception:
+        pass
 
-# Split data into cache-only and needs-api
+with ThreadPoolExecutor(max_workers=4) as executor:
+    futures = [executor.submit(geocode_address, a) for a in to_fetch]
+    for fut in tqdm(as_completed(futures), total=len(futures), desc="Geocoding", unit="addr"):
+        fut.result()
+
+# Second pass: every attempt is now either cached or known to have failed,
+# so rows resolve with pure cache lookups.
 cache_results = [None] * len(data)
-api_indices = []
-api_rows = []
-
-# Helper to check if any attempt is not in cache
-for i, row in enumerate(data):
-    attempts = [
-        row['Full address'],
-        f"{row['Postcode']}, Australia",
-        f"{row['Suburb']}, {row['State']} {row['Postcode']}, Australia"
-    ]
-    found = False
-    for attempt in attempts:
-        if attempt in geocode_cache:
-            lat, lon = geocode_cache[attempt]
-            cache_results[i] = (lat, lon)
-            found = True
-            break
-    if not found:
-        api_indices.append(i)
-        api_rows.append(row)
-
-# Threaded lookup for cache hits
-results = [None] * len(data)
-def cache_lookup(i):
-    return (i, cache_results[i])
-with ThreadPoolExecutor(max_workers=8) as executor:
-    futures = [executor.submit(cache_lookup, i) for i in range(len(data)) if cache_results[i] is not None]
-    for fut in as_completed(futures):
-        i, res = fut.result()
-        results[i] = res
-
-# Sequential API requests for non-cached
-start_time = time.time()
-total = len(data)
-for idx, (i, row) in enumerate(zip(api_indices, api_rows)):
-    lat, lon = None, None
-    attempts = [
-        row['Full address'],
-        f"{row['Postcode']}, Australia",
-        f"{row['Suburb']}, {row['State']} {row['Postcode']}, Australia"
-    ]
+for i, attempts in enumerate(attempts_per_row):
     for attempt in attempts:
-        if attempt in geocode_cache:
-            lat, lon = geocode_cache[attempt]
+        coords = geocode_cache.get(attempt)
+        if coords:
+            cache_results[i] = coords
             break
-        try:
-            location = geolocator.geocode(attempt)
-            if location:
-                lat, lon = location.latitude, location.longitude
-                geocode_cache[attempt] = (lat, lon)
-                break
-        except Exception:
-            pass
-        if attempt not in geocode_cache:
-            time.sleep(1)  # Respect Nominatim's 1 request/sec limit
-    results[i] = (lat, lon)
-    elapsed = time.time() - start_time
-    avg_time = elapsed / (idx+1)
-    remaining = len(api_rows) - (idx+1)
-    eta = datetime.timedelta(seconds=int(avg_time * remaining))
-    print(f"[{i+1}/{total} | ETA: {eta}] Processed: {row['Name']} | Provider#: {row['Provider number']} | Lat: {lat} Lon: {lon}")
-
-# Attach geocode results
-enriched = []
-for i, row in enumerate(data):
-    lat, lon = results[i]
-    row['Latitude'] = lat
-    row['Longitude'] = lon
-    del row['Full address']
-    enriched.append(row)
-
-# Save to CSV
-missing_coords = sum(1 for lat, lon in results if lat is None or lon is None)
-df = pd.DataFrame(enriched)
-df.to_csv('cleaned_providers.csv', index=False)
+    if cache_results[i] is None:
+        cache_results[i] = (None, None)
+
+results = list(cache_results)
+
+# Stream rows to the output CSV as their coordinates resolve, instead of
+# materializing a second enriched copy of the data in memory
+fieldnames = [k for k in data[0].keys() if k != 'Full address'] + ['Latitude', 'Longitude']
+missing_coords = 0
+with open('cleaned_providers.csv', 'w', encoding='utf-8', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=fieldnames)
+    writer.writeheader()
+    for row, (lat, lon) in zip(data, results):
+        if lat is None or lon is None:
+            missing_coords += 1
+        out = {k: v for k, v in row.items() if k != 'Full address'}
+        out['Latitude'] = lat
+        out['Longitude'] = lon
+        writer.writerow(out)
 print('Saved cleaned data to cleaned_providers.csv')
 if missing_coords > 0:
     print(f"Warning: {missing_coords} entries did not have coordinates generated. Please check the address or postcode for these entries.")
 else:
     print("All entries have coordinates.")
 
-# Save geocode cache after processing
-save_geocode_cache(geocode_cache)
+# Flush any uncommitted cache writes
+geocode_cache.close()